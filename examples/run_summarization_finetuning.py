@@ -16,7 +16,9 @@
 """ Finetuning seq2seq models for sequence generation."""
 
 import argparse
+import contextlib
 import functools
+import itertools
 import logging
 import os
 import random
@@ -27,6 +29,7 @@ from tqdm import tqdm, trange
 import torch
 from torch.optim import Adam
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
 
 from transformers import (
     AutoTokenizer,
@@ -39,14 +42,22 @@ from transformers import (
 from utils_summarization import (
     CNNDailyMailDataset,
     encode_for_summarization,
-    fit_to_block_size,
     build_lm_labels,
     build_mask,
     compute_token_type_ids,
 )
 
+try:
+    from apex.multi_tensor_apply import multi_tensor_applier
+    from apex.optimizers import FusedAdam
+
+    # FusedAdam cannot be instantiated if apex was built without its CUDA extensions
+    if not multi_tensor_applier.available:
+        FusedAdam = None
+except ImportError:
+    FusedAdam = None
+
 logger = logging.getLogger(__name__)
-logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
 
 def set_seed(args):
@@ -67,21 +78,27 @@ def load_and_cache_examples(args, tokenizer):
 
 def collate(data, tokenizer, block_size):
     """ List of tuple as an input. """
-    # remove the files with empty an story/summary, encode and fit to block
-    data = filter(lambda x: not (len(x[0]) == 0 or len(x[1]) == 0), data)
+    # remove the files with empty an story/summary
     data = [
-        encode_for_summarization(story, summary, tokenizer) for story, summary in data
+        (story, summary) for story, summary in data if len(story) and len(summary)
     ]
-    data = [
-        (
-            fit_to_block_size(story, block_size, tokenizer.pad_token_id),
-            fit_to_block_size(summary, block_size, tokenizer.pad_token_id),
+
+    # encode and fit to block; the tensors are pre-filled with the padding
+    # token so we only need to copy the (truncated) token ids.
+    stories = torch.full(
+        (len(data), block_size), tokenizer.pad_token_id, dtype=torch.long
+    )
+    summaries = torch.full(
+        (len(data), block_size), tokenizer.pad_token_id, dtype=torch.long
+    )
+    for i, (story_lines, summary_lines) in enumerate(data):
+        story, summary = encode_for_summarization(
+            story_lines, summary_lines, tokenizer, block_size
         )
-        for story, summary in data
-    ]
+        story, summary = story[:block_size], summary[:block_size]
+        stories[i, : len(story)] = torch.tensor(story, dtype=torch.long)
+        summaries[i, : len(summary)] = torch.tensor(summary, dtype=torch.long)
 
-    stories = torch.tensor([story for story, summary in data])
-    summaries = torch.tensor([summary for story, summary in data])
     encoder_token_type_ids = compute_token_type_ids(stories, tokenizer.cls_token_id)
     encoder_mask = build_mask(stories, tokenizer.pad_token_id)
     decoder_mask = build_mask(summaries, tokenizer.pad_token_id)
@@ -97,6 +114,46 @@ def collate(data, tokenizer, block_size):
     )
 
 
+def prefetch_to_device(batches, device):
+    """ Iterate over batches of tensors moved to `device`.
+
+    On GPU the next batch is copied on a side CUDA stream while the current
+    batch is being processed, so that host to device transfers overlap with
+    the computation.
+    """
+    if device.type != "cuda":
+        for batch in batches:
+            yield tuple(tensor.to(device) for tensor in batch)
+        return
+
+    compute_stream = torch.cuda.current_stream(device)
+    copy_stream = torch.cuda.Stream(device=device)
+
+    def copy(batch):
+        with torch.cuda.stream(copy_stream):
+            batch = tuple(tensor.to(device, non_blocking=True) for tensor in batch)
+            copied = torch.cuda.Event()
+            copied.record()
+        return batch, copied
+
+    def wait(batch, copied):
+        compute_stream.wait_event(copied)
+        for tensor in batch:
+            # The memory was allocated on the copy stream, make sure the
+            # allocator does not reuse it before the computation is done.
+            tensor.record_stream(compute_stream)
+        return batch
+
+    pending = None
+    for batch in batches:
+        next_pending = copy(batch)
+        if pending is not None:
+            yield wait(*pending)
+        pending = next_pending
+    if pending is not None:
+        yield wait(*pending)
+
+
 # ----------
 # Optimizers
 # ----------
@@ -109,6 +166,9 @@ class BertSumOptimizer(object):
     summarization using two Adam Optimizers with different warm-up steps and
     learning rate. They also use a custom learning rate scheduler.
 
+    When apex is installed and the model is on GPU we use its `FusedAdam`,
+    which updates all the parameters of a stack in a single kernel launch.
+
     [1] Liu, Yang, and Mirella Lapata. "Text summarization with pretrained encoders."
         arXiv preprint arXiv:1908.08345 (2019).
     """
@@ -119,14 +179,19 @@ class BertSumOptimizer(object):
         self.lr = lr
         self.warmup_steps = warmup_steps
 
+        if FusedAdam is not None and next(model.parameters()).is_cuda:
+            optimizer_class = FusedAdam
+        else:
+            optimizer_class = Adam
+
         self.optimizers = {
-            "encoder": Adam(
+            "encoder": optimizer_class(
                 model.encoder.parameters(),
                 lr=lr["encoder"],
                 betas=(beta_1, beta_2),
                 eps=eps,
             ),
-            "decoder": Adam(
+            "decoder": optimizer_class(
                 model.decoder.parameters(),
                 lr=lr["decoder"],
                 betas=(beta_1, beta_2),
@@ -142,8 +207,8 @@ class BertSumOptimizer(object):
         )
 
     def zero_grad(self):
-        self.optimizer_decoder.zero_grad()
-        self.optimizer_encoder.zero_grad()
+        for optimizer in self.optimizers.values():
+            optimizer.zero_grad()
 
     def step(self):
         self._step += 1
@@ -166,13 +231,19 @@ def train(args, model, tokenizer):
     # Load the data
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
     train_dataset = load_and_cache_examples(args, tokenizer)
-    train_sampler = RandomSampler(train_dataset)
+    train_sampler = (
+        RandomSampler(train_dataset)
+        if args.local_rank == -1
+        else DistributedSampler(train_dataset)
+    )
     model_collate_fn = functools.partial(collate, tokenizer=tokenizer, block_size=512)
     train_dataloader = DataLoader(
         train_dataset,
         sampler=train_sampler,
         batch_size=args.train_batch_size,
         collate_fn=model_collate_fn,
+        num_workers=args.num_workers,
+        pin_memory=args.n_gpu > 0,
     )
 
     # Training schedule
@@ -193,6 +264,30 @@ def train(args, model, tokenizer):
     warmup_steps = {"encoder": 20000, "decoder": 10000}
     optimizer = BertSumOptimizer(model, lr, warmup_steps)
 
+    if args.fp16:
+        try:
+            from apex import amp
+        except ImportError:
+            raise ImportError(
+                "Please install apex from https://www.github.com/nvidia/apex to use fp16 training."
+            )
+        stacks = list(optimizer.optimizers.keys())
+        model, optimizers = amp.initialize(
+            model,
+            [optimizer.optimizers[stack] for stack in stacks],
+            opt_level=args.fp16_opt_level,
+        )
+        optimizer.optimizers = dict(zip(stacks, optimizers))
+
+    # Distributed training (should be after apex fp16 initialization)
+    if args.local_rank != -1:
+        model = torch.nn.parallel.DistributedDataParallel(
+            model,
+            device_ids=[args.local_rank],
+            output_device=args.local_rank,
+            find_unused_parameters=True,
+        )
+
     # Train
     logger.info("***** Running training *****")
     logger.info("  Num examples = %d", len(train_dataset))
@@ -202,53 +297,87 @@ def train(args, model, tokenizer):
     )
     logger.info(
         "  Total train batch size (w. parallel, distributed & accumulation) = %d",
-        args.train_batch_size * args.gradient_accumulation_steps
-        # * (torch.distributed.get_world_size() if args.local_rank != -1 else 1),
+        args.train_batch_size
+        * args.gradient_accumulation_steps
+        * (torch.distributed.get_world_size() if args.local_rank != -1 else 1),
     )
     logger.info("  Gradient Accumulation steps = %d", args.gradient_accumulation_steps)
     logger.info("  Total optimization steps = %d", t_total)
 
-    model.zero_grad()
+    optimizer.zero_grad()
     train_iterator = trange(args.num_train_epochs, desc="Epoch", disable=True)
 
     global_step = 0
-    tr_loss = 0.0
-    for _ in train_iterator:
+    # The loss is accumulated on the device and only copied back to the host
+    # when it is logged, to avoid a synchronization at every step.
+    tr_loss = torch.zeros([], device=args.device)
+    logging_loss = 0.0
+    for epoch in train_iterator:
+        # The distributed sampler shuffles with a seed derived from the epoch
+        if isinstance(train_sampler, DistributedSampler):
+            train_sampler.set_epoch(epoch)
         epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=True)
-        for step, batch in enumerate(epoch_iterator):
+        for step, batch in enumerate(prefetch_to_device(epoch_iterator, args.device)):
             source, target, encoder_token_type_ids, encoder_mask, decoder_mask, lm_labels = batch
 
-            source = source.to(args.device)
-            target = target.to(args.device)
-            encoder_token_type_ids = encoder_token_type_ids.to(args.device)
-            encoder_mask = encoder_mask.to(args.device)
-            decoder_mask = decoder_mask.to(args.device)
-            lm_labels = lm_labels.to(args.device)
-
-            model.train()
-            outputs = model(
-                source,
-                target,
-                encoder_token_type_ids=encoder_token_type_ids,
-                encoder_attention_mask=encoder_mask,
-                decoder_attention_mask=decoder_mask,
-                decoder_lm_labels=lm_labels,
-            )
-
-            loss = outputs[0]
-            print(loss)
-            if args.gradient_accumulation_steps > 1:
-                loss /= args.gradient_accumulation_steps
-
-            loss.backward()
-
-            tr_loss += loss.item()
-            if (step + 1) % args.gradient_accumulation_steps == 0:
-                torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+            # Gradients are only all-reduced across processes on the last
+            # micro-batch of each accumulation cycle.
+            is_accumulating = (step + 1) % args.gradient_accumulation_steps != 0
+            if args.local_rank != -1 and is_accumulating:
+                sync_context = model.no_sync()
+            else:
+                sync_context = contextlib.ExitStack()
+
+            with sync_context:
+                model.train()
+                outputs = model(
+                    source,
+                    target,
+                    encoder_token_type_ids=encoder_token_type_ids,
+                    encoder_attention_mask=encoder_mask,
+                    decoder_attention_mask=decoder_mask,
+                    decoder_lm_labels=lm_labels,
+                )
+
+                loss = outputs[0]
+                if args.gradient_accumulation_steps > 1:
+                    loss /= args.gradient_accumulation_steps
+
+                if args.fp16:
+                    with amp.scale_loss(
+                        loss, list(optimizer.optimizers.values())
+                    ) as scaled_loss:
+                        scaled_loss.backward()
+                else:
+                    loss.backward()
+
+            tr_loss += loss.detach().float()
+            if not is_accumulating:
+                if args.fp16:
+                    parameters = itertools.chain.from_iterable(
+                        amp.master_params(stack_optimizer)
+                        for stack_optimizer in optimizer.optimizers.values()
+                    )
+                else:
+                    parameters = model.parameters()
+                torch.nn.utils.clip_grad_norm_(parameters, args.max_grad_norm)
                 optimizer.step()
-                model.zero_grad()
+                optimizer.zero_grad()
                 global_step += 1
 
+                if (
+                    args.local_rank in [-1, 0]
+                    and args.logging_steps > 0
+                    and global_step % args.logging_steps == 0
+                ):
+                    current_loss = tr_loss.item()
+                    logger.info(
+                        "  step = %d, loss = %f",
+                        global_step,
+                        (current_loss - logging_loss) / args.logging_steps,
+                    )
+                    logging_loss = current_loss
+
             if args.max_steps > 0 and global_step > args.max_steps:
                 epoch_iterator.close()
                 break
@@ -257,7 +386,7 @@ def train(args, model, tokenizer):
             train_iterator.close()
             break
 
-    return global_step, tr_loss / global_step
+    return global_step, tr_loss.item() / global_step
 
 
 # ------------
@@ -271,14 +400,16 @@ def evaluate(args, model, tokenizer, prefix=""):
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
     eval_dataset = load_and_cache_examples(args, tokenizer, evaluate=True)
     eval_sampler = SequentialSampler(eval_dataset)
+    model_collate_fn = functools.partial(collate, tokenizer=tokenizer, block_size=512)
     eval_dataloader = DataLoader(
-        eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size
+        eval_dataset,
+        sampler=eval_sampler,
+        batch_size=args.eval_batch_size,
+        collate_fn=model_collate_fn,
+        num_workers=args.num_workers,
+        pin_memory=args.n_gpu > 0,
     )
 
-    # multi-gpu evaluate
-    if args.n_gpu > 1:
-        model = torch.nn.DataParallel(model)
-        
     logger.info("***** Running evaluation {} *****".format(prefix))
     logger.info("  Num examples = %d", len(eval_dataset))
     logger.info("  Batch size = %d", args.eval_batch_size)
@@ -286,16 +417,10 @@ def evaluate(args, model, tokenizer, prefix=""):
     nb_eval_steps = 0
     model.eval()
 
-    for batch in tqdm(eval_dataloader, desc="Evaluating"):
+    eval_iterator = tqdm(eval_dataloader, desc="Evaluating")
+    for batch in prefetch_to_device(eval_iterator, args.device):
         source, target, encoder_token_type_ids, encoder_mask, decoder_mask, lm_labels = batch
 
-        source = source.to(args.device)
-        target = target.to(args.device)
-        encoder_token_type_ids = encoder_token_type_ids.to(args.device)
-        encoder_mask = encoder_mask.to(args.device)
-        decoder_mask = decoder_mask.to(args.device)
-        lm_labels = lm_labels.to(args.device)
-
         with torch.no_grad():
             outputs = model(
                 source,
@@ -306,7 +431,7 @@ def evaluate(args, model, tokenizer, prefix=""):
                 decoder_lm_labels=lm_labels,
             )
             lm_loss = outputs[0]
-            eval_loss += lm_loss.mean().item()
+            eval_loss += lm_loss.item()
         nb_eval_steps += 1
 
     eval_loss = eval_loss / nb_eval_steps
@@ -382,6 +507,12 @@ def main():
     parser.add_argument(
         "--max_grad_norm", default=1.0, type=float, help="Max gradient norm."
     )
+    parser.add_argument(
+        "--logging_steps",
+        type=int,
+        default=50,
+        help="Log the loss every X updates steps.",
+    )
     parser.add_argument(
         "--max_steps",
         default=-1,
@@ -403,7 +534,33 @@ def main():
         type=int,
         help="Batch size per GPU/CPU for training.",
     )
+    parser.add_argument(
+        "--num_workers",
+        default=None,
+        type=int,
+        help="Number of subprocesses used to load and encode the batches. Defaults to "
+        "the number of CPUs minus two, shared between the processes of a node, on GPU "
+        "and to 0 (encoding in the main process) on CPU.",
+    )
     parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument(
+        "--local_rank",
+        type=int,
+        default=-1,
+        help="For distributed training: local_rank",
+    )
+    parser.add_argument(
+        "--fp16",
+        action="store_true",
+        help="Whether to use 16-bit (mixed) precision (through NVIDIA apex) instead of 32-bit",
+    )
+    parser.add_argument(
+        "--fp16_opt_level",
+        type=str,
+        default="O1",
+        help="For fp16: Apex AMP optimization level selected in ['O0', 'O1', 'O2', and 'O3']."
+        "See details at https://nvidia.github.io/apex/amp.html",
+    )
     args = parser.parse_args()
 
     if (
@@ -418,37 +575,68 @@ def main():
             )
         )
 
-    # Set up training device
+    # Set up training device. Multi-GPU training uses one process per GPU,
+    # launched with `python -m torch.distributed.launch --nproc_per_node=N`.
     if args.to_cpu or not torch.cuda.is_available():
+        if args.local_rank != -1:
+            raise ValueError("Distributed training is only supported on GPU.")
         args.device = torch.device("cpu")
         args.n_gpu = 0
-    else:
+    elif args.local_rank == -1:
         args.device = torch.device("cuda")
-        args.n_gpu = torch.cuda.device_count()
-
-    # Load pretrained model and tokenizer. The decoder's weights are randomly initialized.
-    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
-    config = BertConfig.from_pretrained(args.model_name_or_path)
-    decoder_model = BertForMaskedLM(config)
-    model = Model2Model.from_pretrained(
-        args.model_name_or_path, decoder_model=decoder_model
-    )
+        args.n_gpu = 1
+    else:  # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
+        torch.cuda.set_device(args.local_rank)
+        args.device = torch.device("cuda", args.local_rank)
+        torch.distributed.init_process_group(backend="nccl")
+        args.n_gpu = 1
+
+    # Leave the CPUs to the model when training on CPU; on GPU share them
+    # between the processes (one per GPU) running on this node.
+    if args.num_workers is None:
+        if args.n_gpu == 0:
+            args.num_workers = 0
+        else:
+            processes_per_node = (
+                torch.cuda.device_count() if args.local_rank != -1 else 1
+            )
+            args.num_workers = max(
+                1, ((os.cpu_count() or 1) - 2) // processes_per_node
+            )
 
     # Setup logging
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
         datefmt="%m/%d/%Y %H:%M:%S",
-        level=logging.INFO,
+        stream=sys.stdout,
+        level=logging.INFO if args.local_rank in [-1, 0] else logging.WARN,
     )
     logger.warning(
         "Process rank: %s, device: %s, n_gpu: %s, distributed training: %s, 16-bits training: %s",
-        0,
+        args.local_rank,
         args.device,
         args.n_gpu,
-        False,
-        False,
+        bool(args.local_rank != -1),
+        args.fp16,
     )
 
+    # Load pretrained model and tokenizer. The decoder's weights are randomly initialized.
+    # Barrier to make sure only the first process in distributed training
+    # downloads the model & vocab
+    if args.local_rank not in [-1, 0]:
+        torch.distributed.barrier()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    config = BertConfig.from_pretrained(args.model_name_or_path)
+    decoder_model = BertForMaskedLM(config)
+    model = Model2Model.from_pretrained(
+        args.model_name_or_path, decoder_model=decoder_model
+    )
+
+    # End of barrier: the other processes can now load from the cache
+    if args.local_rank == 0:
+        torch.distributed.barrier()
+
     logger.info("Training/evaluation parameters %s", args)
 
     # Train the model
@@ -457,6 +645,7 @@ def main():
         global_step, tr_loss = train(args, model, tokenizer)
         logger.info(" global_step = %s, average loss = %s", global_step, tr_loss)
 
+    if args.do_train and args.local_rank in [-1, 0]:
         if not os.path.exists(args.output_dir):
             os.makedirs(args.output_dir)
 
@@ -1,7 +1,6 @@
 from collections import deque
 import os
 
-import torch
 from torch.utils.data import Dataset
 
 
@@ -119,44 +118,40 @@ def fit_to_block_size(sequence, block_size, pad_token):
 def build_lm_labels(sequence, pad_token):
     """ Padding token, encoded as 0, are represented by the value -1 so they
     are not taken into account in the loss computation. """
-    padded = sequence.clone()
-    padded[padded == pad_token] = -1
-    return padded
+    return sequence.masked_fill(sequence == pad_token, -1)
 
 
 def build_mask(sequence, pad_token):
     """ Builds the mask. The attention mechanism will only attend to positions
-    with value 1. """
-    mask = torch.ones_like(sequence)
-    idx_pad_tokens = sequence == pad_token
-    mask[idx_pad_tokens] = 0
-    return mask
+    with value 1. The mask is stored as int32, which is enough for 0/1 values
+    and halves the size of the tensors copied to the device. """
+    return (sequence != pad_token).int()
 
 
-def encode_for_summarization(story_lines, summary_lines, tokenizer):
+def encode_for_summarization(story_lines, summary_lines, tokenizer, block_size=None):
     """ Encode the story and summary lines, and join them
     as specified in [1] by using `[SEP] [CLS]` tokens to separate
     sentences.
+
+    If `block_size` is specified we stop encoding lines once the sequence
+    reaches the block size, as the remaining tokens would be truncated anyway.
     """
-    story_lines_token_ids = [
-        tokenizer.add_special_tokens_single_sequence(tokenizer.encode(line))
-        for line in story_lines
-    ]
-    summary_lines_token_ids = [
-        tokenizer.add_special_tokens_single_sequence(tokenizer.encode(line))
-        for line in summary_lines
-    ]
-
-    story_token_ids = [
-        token for sentence in story_lines_token_ids for token in sentence
-    ]
-    summary_token_ids = [
-        token for sentence in summary_lines_token_ids for token in sentence
-    ]
+    story_token_ids = _encode_lines(story_lines, tokenizer, block_size)
+    summary_token_ids = _encode_lines(summary_lines, tokenizer, block_size)
 
     return story_token_ids, summary_token_ids
 
 
+def _encode_lines(lines, tokenizer, block_size=None):
+    token_ids = []
+    for line in lines:
+        if block_size is not None and len(token_ids) >= block_size:
+            break
+        line_token_ids = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(line))
+        token_ids.extend(tokenizer.build_inputs_with_special_tokens(line_token_ids))
+    return token_ids
+
+
 def compute_token_type_ids(batch, separator_token_id):
     """ Segment embeddings as described in [1]
 
@@ -172,13 +167,6 @@ def compute_token_type_ids(batch, separator_token_id):
         arXiv preprint arXiv:1908.08345 (2019).
     [2] https://github.com/nlpyang/PreSumm (/src/prepro/data_builder.py, commit fac1217)
     """
-    batch_embeddings = []
-    for sequence in batch:
-        sentence_num = 0
-        embeddings = []
-        for s in sequence:
-            if s == separator_token_id:
-                sentence_num += 1
-            embeddings.append(sentence_num % 2)
-        batch_embeddings.append(embeddings)
-    return torch.tensor(batch_embeddings)
+    # The sentence number of each token is the number of separators seen so far
+    sentence_num = (batch == separator_token_id).long().cumsum(dim=1)
+    return sentence_num % 2
@@ -12,13 +12,18 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
+import shutil
+import tempfile
 import unittest
 
 import numpy as np
 import torch
 
+from transformers.tokenization_bert import BertTokenizer
 from utils_summarization import (
     compute_token_type_ids,
+    encode_for_summarization,
     fit_to_block_size,
     build_mask,
     build_lm_labels,
@@ -132,5 +137,36 @@ class SummarizationDataProcessingTest(unittest.TestCase):
         np.testing.assert_array_equal(result, expected)
 
 
+class SummarizationEncodingTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdirname = tempfile.mkdtemp()
+        vocab_tokens = ["[UNK]", "[CLS]", "[SEP]", "[PAD]", "it", "was", "the", "best"]
+        vocab_file = os.path.join(self.tmpdirname, "vocab.txt")
+        with open(vocab_file, "w", encoding="utf-8") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+        self.tokenizer = BertTokenizer(vocab_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdirname)
+
+    def test_encode_for_summarization(self):
+        """ Each line is wrapped in `[CLS]` and `[SEP]` tokens. """
+        story_lines = ["it was", "the best"]
+        summary_lines = ["the best"]
+        story, summary = encode_for_summarization(
+            story_lines, summary_lines, self.tokenizer
+        )
+        self.assertEqual(story, [1, 4, 5, 2, 1, 6, 7, 2])
+        self.assertEqual(summary, [1, 6, 7, 2])
+
+    def test_encode_for_summarization_stops_at_block_size(self):
+        """ Lines starting after the block size are not encoded. """
+        story_lines = ["it was", "the best", "it was"]
+        story, _ = encode_for_summarization(
+            story_lines, ["the best"], self.tokenizer, block_size=5
+        )
+        self.assertEqual(story, [1, 4, 5, 2, 1, 6, 7, 2])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -71,8 +71,8 @@ class TransformerBeamSearch(nn.Module):
             [0.0] + [float("-inf")] * (self.beam_size - 1), dtype=torch.float
         ).repeat(batch_size)
         self.results = {
-            "prediction": [[] for _ in batch_size],
-            "scores": [[] for _ in batch_size],
+            "predictions": [[] for _ in range(batch_size)],
+            "scores": [[] for _ in range(batch_size)],
         }
         self._step = 0
         self.is_done = False
@@ -91,7 +91,7 @@ class TransformerBeamSearch(nn.Module):
 
         self.enforce_min_length(log_probabilities)
         if self.block_repeating_trigram:
-            self.remove_repeating_trigrams(log_probabilities, _B)
+            self.remove_repeating_trigrams(log_probabilities)
 
         # Find the `beam_size` (previous_beam + token) combinations with
         # the highest score
@@ -150,10 +150,9 @@ class TransformerBeamSearch(nn.Module):
                 # If the batch reached the end, save the best hypotheses
                 # in terms of length-penalized score.
                 if is_top_beam_finished[i]:
-                    best_hyp = sorted(
-                        self.hypotheses[b], key=lambda x: x[0], reverse=True
+                    best_score, best_prediction = self.best_hypothesis(
+                        self.hypotheses[b]
                     )
-                    best_score, best_prediction = best_hyp[0]
                     self.results["scores"][b].append(best_score)
                     self.results["predictions"][b].append(best_prediction)
 
@@ -197,38 +196,61 @@ class TransformerBeamSearch(nn.Module):
         kwargs_decoder = dict(kwargs_common, **kwargs_decoder)
         kwargs_encoder = dict(kwargs_common, **kwargs_encoder)
 
-        # forward pass on the encoder
-        encoder_outputs = self.model.encoder.forward(encoder_input_ids, kwargs_encoder)
+        # forward pass on the encoder. The source does not change during the
+        # search so we only encode it once and reuse the hidden states (and
+        # the encoder's attention mask) at every decoding step.
+        with torch.no_grad():
+            encoder_outputs = self.model.encoder(encoder_input_ids, **kwargs_encoder)
         kwargs_decoder["encoder_hidden_states"] = tile(
-            encoder_outputs, self.beam_size, dim=0
+            encoder_outputs[0], self.beam_size, dim=0
         )
+        if kwargs_encoder.get("attention_mask", None) is not None:
+            kwargs_decoder["encoder_attention_mask"] = tile(
+                kwargs_encoder["attention_mask"], self.beam_size, dim=0
+            )
 
         # grow the beam by generating sequences in an autoregressive way
-        self.growing_beam = torch.full(
-            (self.batch_size * self.beam_size, 1), self.start_token_id, dtype=torch.long
-        )
         for step in range(self.max_length):
-            decoder_input = self.growing_beam[:, -1]
-            outputs = self.model.decoder(decoder_input, kwargs_decoder)
-            log_probabilities = torch.nn.functional.log_softmax(outputs[1])
+            with torch.no_grad():
+                outputs = self.model.decoder(self.growing_beam, **kwargs_decoder)
+            log_probabilities = torch.nn.functional.log_softmax(
+                outputs[0][:, -1, :], dim=-1
+            )
             surviving_beams_rows = self.step(log_probabilities)
             if self.is_done:
                 break
 
-            kwargs_decoder["encoder_hidden_states"] = kwargs_decoder[
-                "encoder_hidden_states"
-            ].index_select(0, surviving_beams_rows)
+            # only keep the encoder states of the surviving beams
+            for argument in ("encoder_hidden_states", "encoder_attention_mask"):
+                if argument in kwargs_decoder:
+                    kwargs_decoder[argument] = kwargs_decoder[argument].index_select(
+                        0, surviving_beams_rows
+                    )
 
         return self.results
 
-    def remove_repeating_trigrams(self, log_probabilities, _B):
-        if(self._step + 1 > 3):
-            for i in range(_B * self.beam_size):
-                tokens = [t for t in self.growing_beam[i]]
-                trigrams = [(tokens[i-1], tokens[i], tokens[i+1]) for i in range(1, len(words) - 1)]
-                last_trigram = tuple(trigrams[-1])
-                if last_trigram in trigrams[:-1]:
-                    log_probabilities[i] = -1e20
+    @staticmethod
+    def best_hypothesis(hypotheses):
+        """ Returns the (score, prediction) pair with the highest score. """
+        scores = torch.stack([score for score, _ in hypotheses])
+        return hypotheses[scores.argmax().item()]
+
+    def remove_repeating_trigrams(self, log_probabilities):
+        """ Prevents the beams from repeating a trigram.
+
+        A token is blocked when, appended to the last two tokens of a beam,
+        it forms a trigram that already appears in this beam. We look for the
+        earlier occurrences of the beam's last bigram and block the tokens
+        that followed them, for all beams at once.
+        """
+        if self.growing_beam.size(1) < 3:
+            return
+        tokens = self.growing_beam
+        is_last_bigram = (tokens[:, :-2] == tokens[:, -2:-1]) & (
+            tokens[:, 1:-1] == tokens[:, -1:]
+        )
+        rows, positions = is_last_bigram.nonzero().t()
+        log_probabilities[rows, tokens[rows, positions + 2]] = -1e20
 
     def enforce_min_length(self):
         if self._step < self.min_length:
@@ -0,0 +1,93 @@
+# coding=utf-8
+# Copyright 2019 HuggingFace Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import, division, print_function
+
+import unittest
+import pytest
+
+from transformers import is_torch_available
+
+if is_torch_available():
+    import torch
+    from transformers.modeling_beam_search import TransformerBeamSearch
+else:
+    pytestmark = pytest.mark.skip("Require Torch")
+
+
+class StubTokenizer(object):
+    start_token_id = 1
+    end_token_id = 2
+    pad_token_id = 0
+
+
+class TransformerBeamSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.batch_size = 2
+        self.beam_size = 2
+        self.beam = TransformerBeamSearch(
+            model=None,
+            tokenizer=StubTokenizer(),
+            batch_size=self.batch_size,
+            beam_size=self.beam_size,
+            min_length=1,
+            max_length=10,
+        )
+
+    def test_results_initialization(self):
+        self.assertEqual(
+            self.beam.results,
+            {
+                "predictions": [[] for _ in range(self.batch_size)],
+                "scores": [[] for _ in range(self.batch_size)],
+            },
+        )
+
+    def test_best_hypothesis(self):
+        hypotheses = [
+            (torch.tensor(-3.0), torch.tensor([1, 5, 2])),
+            (torch.tensor(-0.5), torch.tensor([1, 6, 2])),
+            (torch.tensor(-1.0), torch.tensor([1, 7, 2])),
+        ]
+        best_score, best_prediction = self.beam.best_hypothesis(hypotheses)
+        self.assertEqual(best_score.item(), -0.5)
+        self.assertListEqual(best_prediction.tolist(), [1, 6, 2])
+
+    def test_remove_repeating_trigrams(self):
+        self.beam.growing_beam = torch.tensor(
+            [
+                [1, 5, 6, 7, 8, 9, 5, 6],  # (5, 6) was followed by 7
+                [5, 6, 3, 5, 6, 4, 5, 6],  # (5, 6) was followed by 3 and 4
+                [1, 2, 3, 4, 5, 6, 7, 8],  # no repeated bigram
+                [9, 8, 7, 6, 5, 4, 3, 2],  # no repeated bigram
+            ]
+        )
+        log_probabilities = torch.zeros(4, 10)
+        self.beam.remove_repeating_trigrams(log_probabilities)
+
+        expected = torch.zeros(4, 10)
+        expected[0, 7] = -1e20
+        expected[1, 3] = -1e20
+        expected[1, 4] = -1e20
+        self.assertListEqual(log_probabilities.tolist(), expected.tolist())
+
+    def test_remove_repeating_trigrams_short_beam(self):
+        self.beam.growing_beam = torch.tensor([[1, 1], [1, 1], [1, 2], [2, 1]])
+        log_probabilities = torch.zeros(4, 10)
+        self.beam.remove_repeating_trigrams(log_probabilities)
+        self.assertListEqual(log_probabilities.tolist(), torch.zeros(4, 10).tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()